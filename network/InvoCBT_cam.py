@@ -1,3 +1,6 @@
+import inspect
+import math
+import re
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,6 +9,50 @@ from functools import partial
 from timm.models.layers import DropPath, trunc_normal_
 
 from network.amm import AMM
+from network.cham import CHAM, ChannelAttention
+from network.cham_unet import CHAMModel
+
+try:
+    from flash_attn.ops.triton.layer_norm import layer_norm_fn
+except ImportError:
+    layer_norm_fn = None
+
+_HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+_HAS_TANH_GELU = 'approximate' in inspect.signature(nn.GELU).parameters
+
+
+def _sdpa_accepts_scale():
+    # scale= only exists from torch 2.1, and the builtin has no inspectable signature
+    q = torch.zeros(1, 1, 1, 1)
+    try:
+        F.scaled_dot_product_attention(q, q, q, scale=1.)
+    except TypeError:
+        return False
+    return True
+
+
+_HAS_SDPA_SCALE = _HAS_SDPA and _sdpa_accepts_scale()
+
+
+# kept off the modules, a torch.cuda.Stream cannot be pickled or deep-copied
+_side_streams = {}
+
+
+def _is_compiling():
+    compiler = getattr(torch, 'compiler', None)
+    return compiler is not None and hasattr(compiler, 'is_compiling') and compiler.is_compiling()
+
+
+def _side_stream(device):
+    if device not in _side_streams:
+        _side_streams[device] = torch.cuda.Stream(device=device)
+    return _side_streams[device]
+
+
+def _make_act(act_layer):
+    if act_layer is nn.GELU and _HAS_TANH_GELU:
+        return nn.GELU(approximate='tanh')
+    return act_layer()
 
 
 class Mlp(nn.Module):
@@ -14,7 +61,7 @@ class Mlp(nn.Module):
         out_features = out_features or in_features
         hidden_features = hidden_features or in_features
         self.fc1 = nn.Linear(in_features, hidden_features)
-        self.act = act_layer()
+        self.act = _make_act(act_layer)
         self.fc2 = nn.Linear(hidden_features, out_features)
         self.drop = nn.Dropout(drop)
 
@@ -33,22 +80,32 @@ class Attention(nn.Module):
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        self.sdpa_kwargs = {'scale': qk_scale} if qk_scale else {}
+        self.use_sdpa = _HAS_SDPA and (not qk_scale or _HAS_SDPA_SCALE)
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    def forward(self, x, need_weights=False):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-        q, k, v = qkv[0], qkv[1], qkv[2]
-
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        q, k, v = qkv.unbind(0)
+
+        if need_weights or not self.use_sdpa:
+            attn = (q * self.scale) @ k.transpose(-2, -1)
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
+            if not need_weights:
+                attn = None
+        else:
+            attn = None
+            x = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.,
+                                               **self.sdpa_kwargs)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
 
@@ -68,10 +125,20 @@ class Block(nn.Module):
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x):
-        y, attn_weight = self.attn(self.norm1(x))
-        x = x + self.drop_path(y)
-        x = x + self.drop_path(self.mlp(self.norm2(x)))
+    def _fuse_add_norm(self, x):
+        # left to inductor under compile_blocks
+        return layer_norm_fn is not None and x.is_cuda and isinstance(self.norm2, nn.LayerNorm) and not _is_compiling()
+
+    def forward(self, x, need_weights=False):
+        y, attn_weight = self.attn(self.norm1(x), need_weights=need_weights)
+        if self._fuse_add_norm(x):
+            # the residual add and norm2 in one kernel, returning both norm2(x + y) and x + y
+            h, x = layer_norm_fn(self.drop_path(y), self.norm2.weight, self.norm2.bias, residual=x,
+                                 eps=self.norm2.eps, prenorm=True)
+        else:
+            x = x + self.drop_path(y)
+            h = self.norm2(x)
+        x = x + self.drop_path(self.mlp(h))
         return x, attn_weight
 
 
@@ -97,8 +164,6 @@ class ConvBlock(nn.Module):
         self.bn3 = norm_layer(outplanes)
         self.act3 = act_layer()
 
-        self.conv4 = nn.Conv2d(med_planes, med_planes, kernel_size=1, stride=1, padding=0, bias=False)
-
         if res_conv:
             self.residual_conv = nn.Conv2d(inplanes, outplanes, kernel_size=1, stride=stride, padding=0, bias=False)
             self.residual_bn = norm_layer(outplanes)
@@ -107,6 +172,13 @@ class ConvBlock(nn.Module):
         self.drop_block = drop_block
         self.drop_path = drop_path
 
+        self._register_load_state_dict_pre_hook(self._drop_legacy_keys)
+
+    @staticmethod
+    def _drop_legacy_keys(state_dict, prefix, *args):
+        # older checkpoints still carry the weight of an unused conv4 layer
+        state_dict.pop(prefix + 'conv4.weight', None)
+
     def zero_init_last_bn(self):
         nn.init.zeros_(self.bn3.weight)
 
@@ -125,9 +197,6 @@ class ConvBlock(nn.Module):
             x = self.drop_block(x)
         x2 = self.act2(x)
 
-        x = self.bn2(x)
-        x = self.act2(x)
-
         x = self.conv3(x2)
         x = self.bn3(x)
         if self.drop_block is not None:
@@ -160,15 +229,15 @@ class AMPDown(nn.Module):
         self.avg_pool = nn.AvgPool2d(kernel_size=dw_stride, stride=dw_stride)
 
         self.ln = norm_layer(outplanes)
-        self.act = act_layer()
+        self.act = _make_act(act_layer)
 
     def forward(self, x, x_t):
         x = self.conv_project(x)
-        x = self.max_pool(x).flatten(2).transpose(1, 2)
+        x = self.max_pool(x).permute(0, 2, 3, 1).flatten(1, 2)
         x = self.ln(x)
         x = self.act(x)
 
-        x = torch.cat([x_t[:, 0][:, None, :], x], dim=1)
+        x = torch.cat([x_t[:, :1], x], dim=1)
 
         return x
 
@@ -185,7 +254,7 @@ class AMPUp(nn.Module):
 
     def forward(self, x, H, W):
         B, _, C = x.shape
-        x_r = x[:, 1:].transpose(1, 2).reshape(B, C, H, W)
+        x_r = x[:, 1:].reshape(B, H, W, C).permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last)
         x_r = self.act(self.bn(self.conv_project(x_r)))
         out = F.interpolate(x_r, size=(H * self.up_stride, W * self.up_stride))
 
@@ -283,14 +352,14 @@ class ConvTransBlock(nn.Module):
         self.num_med_block = num_med_block
         self.last_fusion = last_fusion
 
-    def forward(self, x, x_t):
+    def forward(self, x, x_t, need_weights=False):
         x, x2 = self.cnn_block(x)
 
         _, _, H, W = x2.shape
 
         x_st = self.squeeze_block(x2, x_t)
 
-        x_t, attn_weight = self.trans_block(x_st + x_t)
+        x_t, attn_weight = self.trans_block(x_st + x_t, need_weights=need_weights)
 
         if self.num_med_block > 0:
             for m in self.med_block:
@@ -382,16 +451,11 @@ class Decoder(nn.Module):
         self.n_class = self.params['class_num']
         self.bilinear = self.params['bilinear']
         self.linear_layer = self.params['linear_layer']
-        assert (len(self.ft_chns) == 5)
 
-        self.up1 = UpBlock_UNet(
-            self.ft_chns[4], self.ft_chns[3], self.ft_chns[3], dropout_p=0.0, bilinear=self.bilinear)
-        self.up2 = UpBlock_UNet(
-            self.ft_chns[3], self.ft_chns[2], self.ft_chns[2], dropout_p=0.0, bilinear=self.bilinear)
-        self.up3 = UpBlock_UNet(
-            self.ft_chns[2], self.ft_chns[1], self.ft_chns[1], dropout_p=0.0, bilinear=self.bilinear)
-        self.up4 = UpBlock_UNet(
-            self.ft_chns[1], self.ft_chns[0], self.ft_chns[0], dropout_p=0.0, bilinear=self.bilinear)
+        # ups[0] fuses the deepest feature with the next one up, ups[-1] ends at ft_chns[0]
+        self.ups = nn.ModuleList([
+            UpBlock_UNet(self.ft_chns[i + 1], self.ft_chns[i], self.ft_chns[i], dropout_p=0.0, bilinear=self.bilinear)
+            for i in range(len(self.ft_chns) - 2, -1, -1)])
 
         if self.linear_layer:
             self.out_conv = nn.Linear(self.ft_chns[0], self.n_class)
@@ -399,17 +463,22 @@ class Decoder(nn.Module):
             self.out_conv = nn.Conv2d(self.ft_chns[0], self.n_class,
                                       kernel_size=3, padding=1)
 
-    def forward(self, feature):
-        x0 = feature[0]
-        x1 = feature[1]
-        x2 = feature[2]
-        x3 = feature[3]
-        x4 = feature[4]
+        self._register_load_state_dict_pre_hook(self._remap_legacy_keys)
 
-        x = self.up1(x4, x3)
-        x = self.up2(x, x2)
-        x = self.up3(x, x1)
-        x = self.up4(x, x0)
+    @staticmethod
+    def _remap_legacy_keys(state_dict, prefix, *args):
+        # older checkpoints name the up blocks up1..up4
+        legacy = re.compile('^' + re.escape(prefix) + r'up(\d+)\.')
+        for key in list(state_dict.keys()):
+            match = legacy.match(key)
+            if match is not None:
+                new_key = '%sups.%d.%s' % (prefix, int(match.group(1)) - 1, key[match.end():])
+                state_dict[new_key] = state_dict.pop(key)
+
+    def forward(self, feature):
+        x = feature[-1]
+        for i, up in enumerate(self.ups):
+            x = up(x, feature[-2 - i])
 
         if self.linear_layer:
             x = x.permute([0, 2, 3, 1]).contiguous()
@@ -465,54 +534,6 @@ class Decoder_trans(nn.Module):
         return output
 
 
-class Decoder_cam(nn.Module):
-    def __init__(self, params):
-        super(Decoder_cam, self).__init__()
-        self.params = params
-        self.in_chns = self.params['in_chns']
-        self.ft_chns = self.params['feature_chns']
-        self.n_class = self.params['class_num']
-        self.bilinear = self.params['bilinear']
-        self.linear_layer = self.params['linear_layer']
-        assert (len(self.ft_chns) == 5)
-
-        self.up1 = UpBlock_UNet(
-            self.ft_chns[4], self.ft_chns[3], self.ft_chns[3], dropout_p=0.0, bilinear=self.bilinear)
-        self.up2 = UpBlock_UNet(
-            self.ft_chns[3], self.ft_chns[2], self.ft_chns[2], dropout_p=0.0, bilinear=self.bilinear)
-        self.up3 = UpBlock_UNet(
-            self.ft_chns[2], self.ft_chns[1], self.ft_chns[1], dropout_p=0.0, bilinear=self.bilinear)
-        self.up4 = UpBlock_UNet(
-            self.ft_chns[1], self.ft_chns[0], self.ft_chns[0], dropout_p=0.0, bilinear=self.bilinear)
-
-        if self.linear_layer:
-            self.out_conv = nn.Linear(self.ft_chns[0], self.n_class)
-        else:
-            self.out_conv = nn.Conv2d(self.ft_chns[0], self.n_class,
-                                      kernel_size=3, padding=1)
-
-    def forward(self, feature):
-        x0 = feature[0]
-        x1 = feature[1]
-        x2 = feature[2]
-        x3 = feature[3]
-        x4 = feature[4]
-
-        x = self.up1(x4, x3)
-        x = self.up2(x, x2)
-        x = self.up3(x, x1)
-        x = self.up4(x, x0)
-
-        if self.linear_layer:
-            x = x.permute([0, 2, 3, 1]).contiguous()
-            output = self.out_conv(x)
-            output = output.permute([0, 3, 1, 2]).contiguous()
-        else:
-            output = self.out_conv(x)
-
-        return output
-
-
 class DownBlock(nn.Module):
     def __init__(self, in_channels, out_channels, dropout_p, act_layer=nn.ReLU,
                  norm_layer=partial(nn.BatchNorm2d, eps=1e-6)):
@@ -523,9 +544,13 @@ class DownBlock(nn.Module):
         self.bn1 = norm_layer(out_channels)
         self.act1 = act_layer()
 
-    def forward(self, x):
+    def forward(self, x, num_inputs=1):
         x = self.conv1(x)
-        x = self.bn1(x)
+        if self.training and num_inputs > 1:
+            # x stacks several inputs along the batch; keep their batch statistics separate
+            x = torch.cat([self.bn1(t) for t in x.chunk(num_inputs)], dim=0)
+        else:
+            x = self.bn1(x)
         return self.act1(x)
 
 
@@ -547,10 +572,11 @@ class Encoder_cam(nn.Module):
             self.ft_chns[3], self.ft_chns[4], self.dropout[4])
 
     def forward(self, x):
-        x0 = self.down4(self.down3(self.down2(self.down1(x[0]))))
-        x1 = self.down4(self.down3(self.down2(x[1])))
-        x2 = self.down4(self.down3(x[2]))
-        x3 = self.down4(x[3])
+        y = self.down1(x[0])
+        for down, x_i in zip([self.down2, self.down3, self.down4], x[1:4]):
+            y = torch.cat([y, x_i], dim=0)
+            y = down(y, num_inputs=y.shape[0] // x_i.shape[0])
+        x0, x1, x2, x3 = y.chunk(4)
         x4 = x[4]
         return [x0, x1, x2, x3, x4]
 
@@ -574,12 +600,12 @@ class Net(nn.Module):
         stage_1_channel = int(base_channel * channel_ratio)
         trans_dw_stride = patch_size // 4
         self.conv_1 = ConvBlock(inplanes=in_chans, outplanes=stage_1_channel // 4, res_conv=True, stride=1)
-        self.amm_1 = AMM(stage_1_channel // 4, 16)
-        self.conv_cls_head_1 = nn.Conv2d(stage_1_channel // 4, self.num_classes, 1, bias=False)
+        amms = [AMM(stage_1_channel // 4, 16)]
+        cls_heads = [nn.Linear(stage_1_channel // 4, self.num_classes, bias=False)]
 
         self.conv_2 = ConvBlock(inplanes=stage_1_channel // 4, outplanes=stage_1_channel // 2, res_conv=True, stride=1)
-        self.amm_2 = AMM(stage_1_channel // 2, 16)
-        self.conv_cls_head_2 = nn.Conv2d(stage_1_channel // 2, self.num_classes, 1, bias=False)
+        amms.append(AMM(stage_1_channel // 2, 16))
+        cls_heads.append(nn.Linear(stage_1_channel // 2, self.num_classes, bias=False))
 
         self.conv_3 = ConvBlock(inplanes=stage_1_channel // 2, outplanes=stage_1_channel, res_conv=True, stride=1)
 
@@ -589,21 +615,20 @@ class Net(nn.Module):
                              qk_scale=qk_scale, drop=drop_rate, attn_drop=attn_drop_rate, drop_path=self.trans_dpr[0],
                              )
 
+        conv_trans = []
         init_stage = 2
         fin_stage = depth // 3 + 1
         for i in range(init_stage, fin_stage):
-            self.add_module('conv_trans_' + str(i),
-                            ConvTransBlock(
-                                stage_1_channel, stage_1_channel, False, 1, dw_stride=trans_dw_stride,
-                                embed_dim=embed_dim,
-                                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                                drop_rate=drop_rate, attn_drop_rate=attn_drop_rate,
-                                drop_path_rate=self.trans_dpr[i - 1],
-                                num_med_block=num_med_block
-                            )
-                            )
-        self.amm_3 = AMM(stage_1_channel, 16)
-        self.conv_cls_head_3 = nn.Conv2d(stage_1_channel, self.num_classes, 1, bias=False)
+            conv_trans.append(ConvTransBlock(
+                stage_1_channel, stage_1_channel, False, 1, dw_stride=trans_dw_stride,
+                embed_dim=embed_dim,
+                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
+                drop_rate=drop_rate, attn_drop_rate=attn_drop_rate,
+                drop_path_rate=self.trans_dpr[i - 1],
+                num_med_block=num_med_block
+            ))
+        amms.append(AMM(stage_1_channel, 16))
+        cls_heads.append(nn.Linear(stage_1_channel, self.num_classes, bias=False))
 
         stage_2_channel = int(base_channel * channel_ratio * 2)
         init_stage = fin_stage
@@ -612,18 +637,16 @@ class Net(nn.Module):
             s = 2 if i == init_stage else 1
             in_channel = stage_1_channel if i == init_stage else stage_2_channel
             res_conv = True if i == init_stage else False
-            self.add_module('conv_trans_' + str(i),
-                            ConvTransBlock(
-                                in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride // 2,
-                                embed_dim=embed_dim,
-                                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                                drop_rate=drop_rate, attn_drop_rate=attn_drop_rate,
-                                drop_path_rate=self.trans_dpr[i - 1],
-                                num_med_block=num_med_block
-                            )
-                            )
-        self.amm_4 = AMM(stage_2_channel, 16)
-        self.conv_cls_head_4 = nn.Conv2d(stage_2_channel, self.num_classes, 1, bias=False)
+            conv_trans.append(ConvTransBlock(
+                in_channel, stage_2_channel, res_conv, s, dw_stride=trans_dw_stride // 2,
+                embed_dim=embed_dim,
+                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
+                drop_rate=drop_rate, attn_drop_rate=attn_drop_rate,
+                drop_path_rate=self.trans_dpr[i - 1],
+                num_med_block=num_med_block
+            ))
+        amms.append(AMM(stage_2_channel, 16))
+        cls_heads.append(nn.Linear(stage_2_channel, self.num_classes, bias=False))
 
         stage_3_channel = int(base_channel * channel_ratio * 2 * 2)
         init_stage = fin_stage
@@ -633,24 +656,33 @@ class Net(nn.Module):
             in_channel = stage_2_channel if i == init_stage else stage_3_channel
             res_conv = True if i == init_stage else False
             last_fusion = True if i == depth else False
-            self.add_module('conv_trans_' + str(i),
-                            ConvTransBlock(
-                                in_channel, stage_3_channel, res_conv, s, dw_stride=trans_dw_stride // 4,
-                                embed_dim=embed_dim,
-                                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                                drop_rate=drop_rate, attn_drop_rate=attn_drop_rate,
-                                drop_path_rate=self.trans_dpr[i - 1],
-                                num_med_block=num_med_block, last_fusion=last_fusion
-                            )
-                            )
-        self.amm_5 = AMM(stage_3_channel, 16)
-        self.conv_cls_head_5 = nn.Conv2d(stage_3_channel, self.num_classes, 1, bias=False)
-
+            conv_trans.append(ConvTransBlock(
+                in_channel, stage_3_channel, res_conv, s, dw_stride=trans_dw_stride // 4,
+                embed_dim=embed_dim,
+                num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
+                drop_rate=drop_rate, attn_drop_rate=attn_drop_rate,
+                drop_path_rate=self.trans_dpr[i - 1],
+                num_med_block=num_med_block, last_fusion=last_fusion
+            ))
+        amms.append(AMM(stage_3_channel, 16))
+        cls_heads.append(nn.Linear(stage_3_channel, self.num_classes, bias=False))
+
+        # conv_trans[i - 2] is ConvTransBlock i, amms[j] / cls_heads[j] the CAM branch of scale j + 1
+        self.conv_trans = nn.ModuleList(conv_trans)
+        self.amms = nn.ModuleList(amms)
+        self.cls_heads = nn.ModuleList(cls_heads)
         self.fin_stage = fin_stage
+        self._register_load_state_dict_pre_hook(self._remap_legacy_keys)
 
         trunc_normal_(self.cls_token, std=.02)
 
         self.apply(self._init_weights)
+        for head in self.cls_heads:
+            # same init the heads had as 1x1 Conv2d layers
+            nn.init.kaiming_normal_(head.weight, mode='fan_out', nonlinearity='relu')
+        for m in self.modules():
+            if isinstance(m, ChannelAttention):
+                m.reset_parameters()
 
         params_cnn = {'in_chns': in_chans,
                       'feature_chns': [base_channel * channel_ratio // 4, base_channel * channel_ratio // 2,
@@ -674,6 +706,8 @@ class Net(nn.Module):
                       'dropout': [0.05, 0.1, 0.2, 0.3, 0.5], }
         self.encoder_cam = Encoder_cam(params_cam)
 
+        self.to(memory_format=torch.channels_last)
+
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
             trunc_normal_(m.weight, std=.02)
@@ -691,45 +725,117 @@ class Net(nn.Module):
             nn.init.constant_(m.weight, 1.)
             nn.init.constant_(m.bias, 0.)
 
+    @staticmethod
+    def _remap_legacy_keys(state_dict, prefix, *args):
+        # checkpoints saved before the ModuleList refactor use conv_trans_<i>, amm_<j> and conv_cls_head_<j>
+        legacy = re.compile('^' + re.escape(prefix) + r'(conv_trans_|amm_|conv_cls_head_)(\d+)\.')
+        offsets = {'conv_trans_': ('conv_trans', 2), 'amm_': ('amms', 1), 'conv_cls_head_': ('cls_heads', 1)}
+        for key in list(state_dict.keys()):
+            match = legacy.match(key)
+            if match is None:
+                continue
+            name, offset = offsets[match.group(1)]
+            new_key = '%s%s.%d.%s' % (prefix, name, int(match.group(2)) - offset, key[match.end():])
+            state_dict[new_key] = state_dict.pop(key)
+        # the CAM heads used to be 1x1 Conv2d layers
+        for key in list(state_dict.keys()):
+            if key.startswith(prefix + 'cls_heads.') and state_dict[key].dim() == 4:
+                state_dict[key] = state_dict[key].flatten(1)
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'cls_token'}
 
+    def prepare_for_inference(self):
+        # one-way switch for deployment, do not train the model afterwards
+        self.eval()
+        for module in list(self.modules()):
+            for name, child in module.named_children():
+                if isinstance(child, (DropPath, nn.Dropout)):
+                    setattr(module, name, nn.Identity())
+            if isinstance(module, CHAMModel):
+                module.fuse_for_inference()
+            elif isinstance(module, CHAM):
+                module.fuse()
+        return self
+
+    def quantize_dynamic_int8(self):
+        # returns an int8 copy for CPU inference
+        from torch.ao.quantization import quantize_dynamic, per_channel_dynamic_qconfig
+
+        qconfig = {}
+        for name, m in self.named_modules():
+            if isinstance(m, Attention):
+                qconfig[name + '.qkv'] = per_channel_dynamic_qconfig
+            elif isinstance(m, Mlp):
+                qconfig[name + '.fc1'] = per_channel_dynamic_qconfig
+                qconfig[name + '.fc2'] = per_channel_dynamic_qconfig
+            elif isinstance(m, ChannelAttention):
+                qconfig[name + '.fc.0'] = per_channel_dynamic_qconfig
+                qconfig[name + '.fc.2'] = per_channel_dynamic_qconfig
+        return quantize_dynamic(self, qconfig, dtype=torch.qint8)
+
+    def compile_blocks(self, **kwargs):
+        if not hasattr(nn.Module, 'compile'):
+            raise RuntimeError('compile_blocks needs torch >= 2.2 (nn.Module.compile)')
+        blocks = [self.trans_1] + [m.trans_block for m in self.conv_trans]
+        for block in blocks:
+            block.compile(dynamic=False, **kwargs)
+        for m in self.modules():
+            if isinstance(m, ChannelAttention):
+                m.use_compiled = True
+
     def returnCAM(self, x, weight_softmax):
         x = x.permute([0, 2, 3, 1]).contiguous()
         output = weight_softmax(x)
         output = output.permute([0, 3, 1, 2]).contiguous()
         return output
 
+    def _cam_head(self, j, x):
+        x_amm = self.amms[j](x)
+        x_cam = self.cls_heads[j](x_amm.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        return F.relu(x_cam, )
+
+    def _cam_branch(self, j, x):
+        # the CAM branches only feed encoder_cam
+        if not x.is_cuda:
+            return self._cam_head(j, x)
+        side_stream = _side_stream(x.device)
+        main_stream = torch.cuda.current_stream(x.device)
+        side_stream.wait_stream(main_stream)
+        with torch.cuda.stream(side_stream):
+            x_cam = self._cam_head(j, x)
+        x.record_stream(side_stream)
+        x_cam.record_stream(main_stream)
+        return x_cam
+
     def forward(self, x):
+        seg_conv, seg_trans, seg_cam, _ = self._forward(x, need_weights=False)
+        return seg_conv, seg_trans, seg_cam
+
+    def forward_with_attn(self, x):
+        # forward plus every transformer block's attention map
+        return self._forward(x, need_weights=True)
+
+    def _forward(self, x, need_weights):
+        x = x.contiguous(memory_format=torch.channels_last)
         B = x.shape[0]
         cls_tokens = self.cls_token.expand(B, -1, -1)
 
         feature_conv = []
         feature_trans = []
         x_cams = []
-        conv_flats = []
-
-        attn_weights = []
 
         x = self.conv_1(x, return_x_2=False)
         feature_conv.append(x)
-        x_amm1 = self.amm_1(x)
-        x_cam1 = self.conv_cls_head_1(x_amm1)
-        x_cam1 = F.relu(x_cam1, )
+        x_cam1 = self._cam_branch(0, x)
         x_cams.append(x_cam1)
-        conv_flat = x_cam1.flatten(start_dim=2)
-        conv_flats.append(conv_flat)
 
         x = self.maxpool(x)
         x = self.conv_2(x, return_x_2=False)
         feature_conv.append(x)
-        x_amm2 = self.amm_2(x)
-        x_cam2 = self.conv_cls_head_2(x_amm2)
-        x_cam2 = F.relu(x_cam2, )
+        x_cam2 = self._cam_branch(1, x)
         x_cams.append(x_cam2)
-        conv_flat = x_cam2.flatten(start_dim=2)
-        conv_flats.append(conv_flat)
 
         x = self.maxpool(x)
         x = self.conv_3(x, return_x_2=False)
@@ -737,30 +843,30 @@ class Net(nn.Module):
         x_t = self.trans_patch_conv(x).flatten(2).transpose(1, 2)
         x_t = torch.cat([cls_tokens, x_t], dim=1)
 
-        x_t, attn_weight = self.trans_1(x_t)
-        attn_weights.append(attn_weight)
+        x_t, attn_weight = self.trans_1(x_t, need_weights=need_weights)
+        attn_weights = [attn_weight] if need_weights else None
 
         for i in range(2, self.fin_stage):
-            x, x_t, attn_weight = eval('self.conv_trans_' + str(i))(x, x_t)
-            attn_weights.append(attn_weight)
+            x, x_t, attn_weight = self.conv_trans[i - 2](x, x_t, need_weights=need_weights)
+            if need_weights:
+                attn_weights.append(attn_weight)
 
             if i % 4 == 0:
                 feature_conv.append(x)
                 feature_trans.append(x_t)
-                x_amm = eval('self.amm_' + str(i // 4 + 2))(x)
-                x_cam = eval('self.conv_cls_head_' + str(i // 4 + 2))(x_amm)
-                x_cam = F.relu(x_cam, )
+                x_cam = self._cam_branch(i // 4 + 1, x)
                 x_cams.append(x_cam)
-                conv_flat = x_cam.flatten(start_dim=2)
-                conv_flats.append(conv_flat)
 
         x_patch = x_t[:, 1:]
         n, p, c = x_patch.shape
-        x_patch = torch.reshape(x_patch, [n, int(p ** 0.5), int(p ** 0.5), c])
-        x_patch = x_patch.permute([0, 3, 1, 2]).contiguous()
+        grid = math.isqrt(p)
+        x_patch = torch.reshape(x_patch, [n, grid, grid, c])
+        x_patch = x_patch.permute([0, 3, 1, 2]).contiguous(memory_format=torch.channels_last)
 
         seg_conv = self.decoder_cnn(feature_conv)
         seg_trans = self.decoder_trans(x_patch)
+        if x.is_cuda:
+            torch.cuda.current_stream(x.device).wait_stream(_side_stream(x.device))
         seg_cam = self.encoder_cam(x_cams)
 
-        return seg_conv, seg_trans, seg_cam
+        return seg_conv, seg_trans, seg_cam, attn_weights
@@ -1,41 +1,193 @@
 from torch import nn
 import torch
+import torch.nn.functional as F
+
+
+def _pool_avg_max(x):
+    # avg / max descriptors as one 2N x C batch
+    return torch.cat([x.mean(dim=(2, 3)), x.amax(dim=(2, 3))], dim=0)
+
+
+_pool_avg_max_fused = torch.compile(_pool_avg_max, dynamic=True) if hasattr(torch, 'compile') else _pool_avg_max
+
+
+def _channel_gate(pooled, w1, w2):
+    avg_out, max_out = F.linear(F.relu(F.linear(pooled, w1)), w2).chunk(2, dim=0)
+    return (avg_out + max_out).float().sigmoid_()
+
+
+def _cpu_autocast_enabled():
+    try:
+        return torch.is_autocast_enabled('cpu')
+    except TypeError:
+        return torch.is_autocast_cpu_enabled()
+
+
+_channel_gate_fused = torch.compile(_channel_gate, dynamic=True) if hasattr(torch, 'compile') else _channel_gate
 
 
 class ChannelAttention(nn.Module):
 
-    def __init__(self, in_channels, ratio=16):
+    def __init__(self, in_channels, ratio=16, gate_layer=nn.Sigmoid):
         super(ChannelAttention, self).__init__()
-        self.avg_pool = nn.AdaptiveAvgPool2d(1)
-        self.max_pool = nn.AdaptiveMaxPool2d(1)
 
         self.fc = nn.Sequential(
-            nn.Conv2d(in_channels, in_channels // ratio, 1, bias=False),
+            nn.Linear(in_channels, in_channels // ratio, bias=False),
             nn.ReLU(inplace=True),
-            nn.Conv2d(in_channels // ratio, in_channels, 1, bias=False)
+            nn.Linear(in_channels // ratio, in_channels, bias=False)
         )
 
-        self.sigmoid = nn.Sigmoid()
+        # e.g. nn.Hardsigmoid, only for models trained with it
+        self.gate_act = gate_layer()
+
+        self.use_compiled = False
+        self._use_workspace = False
+        self._workspace = None
+
+        self.reset_parameters()
+        self._register_load_state_dict_pre_hook(self._flatten_legacy_weights)
+
+    def reset_parameters(self):
+        nn.init.kaiming_normal_(self.fc[0].weight, mode='fan_out', nonlinearity='relu')
+        nn.init.kaiming_normal_(self.fc[2].weight, mode='fan_out', nonlinearity='relu')
+
+    @staticmethod
+    def _flatten_legacy_weights(state_dict, prefix, *args):
+        # older checkpoints store 1x1 Conv2d weights
+        for key in (prefix + 'fc.0.weight', prefix + 'fc.2.weight'):
+            if key in state_dict and state_dict[key].dim() == 4:
+                state_dict[key] = state_dict[key].flatten(1)
+
+    def train(self, mode=True):
+        if mode:
+            self._use_workspace = False
+            self._workspace = None
+        return super(ChannelAttention, self).train(mode)
+
+    def _workspace_ok(self, x):
+        return (self._use_workspace and not x.is_cuda and not torch.is_grad_enabled()
+                and type(self.gate_act) is nn.Sigmoid and type(self.fc[0]) is nn.Linear
+                and x.dtype == self.fc[0].weight.dtype and not _cpu_autocast_enabled())
+
+    def _gate_in_workspace(self, x):
+        # the returned gate is a view into buffers reused by the next call
+        n, c = x.shape[:2]
+        ws = self._workspace
+        if (ws is None or ws[0].shape[0] != 2 * n or ws[0].dtype != x.dtype or ws[0].device != x.device
+                or ws[0].is_inference() != torch.is_inference_mode_enabled()):
+            ws = self._workspace = (x.new_empty(2 * n, c), x.new_empty(2 * n, self.fc[0].out_features),
+                                    x.new_empty(2 * n, c))
+        pooled, hidden, logits = ws
+        torch.mean(x, dim=(2, 3), out=pooled[:n])
+        torch.amax(x, dim=(2, 3), out=pooled[n:])
+        torch.mm(pooled, self.fc[0].weight.t(), out=hidden).relu_()
+        torch.mm(hidden, self.fc[2].weight.t(), out=logits)
+        return logits[:n].add_(logits[n:]).sigmoid_()
 
     def forward(self, x):
-        avg_out = self.fc(self.avg_pool(x))
-        max_out = self.fc(self.max_pool(x))
-        out = avg_out + max_out
-        out = self.sigmoid(out)
-        return out * x
+        plain = type(self.gate_act) is nn.Sigmoid and type(self.fc[0]) is nn.Linear
+        compiled = self.use_compiled and x.is_cuda
+        pooled = _pool_avg_max_fused(x) if compiled else _pool_avg_max(x)
+        if plain:
+            channel_gate = _channel_gate_fused if compiled else _channel_gate
+            gate = channel_gate(pooled, self.fc[0].weight, self.fc[2].weight)
+        else:
+            avg_out, max_out = self.fc(pooled).chunk(2, dim=0)
+            gate = self.gate_act((avg_out + max_out).float())
+        return gate.to(x.dtype).unsqueeze(2).unsqueeze(3)
 
 class CHAM(nn.Module):
 
-    def __init__(self, in_channels, ratio=16, kernel_size=3):
+    def __init__(self, in_channels, ratio=16, kernel_size=3, gate_layer=nn.Sigmoid):
         super(CHAM, self).__init__()
-        self.channelattention = ChannelAttention(in_channels, ratio=ratio)
+        self.channelattention = ChannelAttention(in_channels, ratio=ratio, gate_layer=gate_layer)
 
         self.alpha = nn.Parameter(torch.ones(1))
+        self.register_buffer('_one', torch.ones(1), persistent=False)
+        self._alpha_const = None
+        self.register_buffer('_bn_scale', None, persistent=False)
+        self.register_buffer('_bn_shift', None, persistent=False)
+        self._graphs = {}
+
+    @torch.no_grad()
+    def fuse(self, bn=None):
+        # inference only; bn is an eval BatchNorm2d directly after this module, which the caller then replaces
+        # with nn.Identity. train() undoes the rest but refuses a folded bn
+        self._alpha_const = self.alpha.item()
+        self.channelattention._use_workspace = True
+        if bn is not None:
+            k = torch.rsqrt(bn.running_var + bn.eps)
+            shift = -bn.running_mean * k
+            if bn.affine:
+                k = k * bn.weight
+                shift = shift * bn.weight + bn.bias
+            self._bn_scale = k.view(1, -1, 1, 1)
+            self._bn_shift = shift.view(1, -1, 1, 1)
+        return self
+
+    def quantize_for_inference(self):
+        # CPU inference only
+        from torch.ao.quantization import quantize_dynamic
+
+        self.channelattention.fc = quantize_dynamic(self.channelattention.fc, {nn.Linear}, dtype=torch.qint8)
+        return self
+
+    @torch.no_grad()
+    def capture(self, example, warmup=3):
+        # CUDA inference only, undone by train(); call after fuse() if at all
+        static_in = example.detach().contiguous(memory_format=torch.channels_last).clone()
+
+        side = torch.cuda.Stream()
+        side.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side):
+            for _ in range(warmup):
+                self._forward(static_in)
+        torch.cuda.current_stream().wait_stream(side)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = self._forward(static_in)
+        self._graphs[self._graph_key(static_in)] = (graph, static_in, static_out)
+        return self
+
+    @staticmethod
+    def _graph_key(x):
+        return tuple(x.shape), x.dtype, x.device
+
+    def train(self, mode=True):
+        if mode:
+            if self._bn_scale is not None:
+                raise RuntimeError('CHAM has a BatchNorm folded in by fuse(bn) and cannot be trained')
+            self._alpha_const = None
+            self._graphs = {}
+        return super(CHAM, self).train(mode)
 
     def forward(self, x):
-        inputs = x
-        x = self.channelattention(x)
+        if self._graphs and not torch.is_grad_enabled():
+            captured = self._graphs.get(self._graph_key(x))
+            if captured is not None:
+                graph, static_in, static_out = captured
+                static_in.copy_(x)
+                graph.replay()
+                return static_out.clone()
+        return self._forward(x)
+
+    def _forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
+        if self.channelattention._workspace_ok(x):
+            # consumed below, before the next call overwrites it
+            gate = self.channelattention._gate_in_workspace(x)[:, :, None, None]
+        else:
+            gate = self.channelattention(x)
 
-        out = (1 - self.alpha) * x + self.alpha * inputs
+        # (1 - alpha) * gate * x + alpha * x, with the blend folded into the gate
+        alpha = self._alpha_const
+        if alpha is None:
+            scale = torch.lerp(gate.float(), self._one, self.alpha).to(x.dtype)
+        else:
+            scale = gate.mul(1 - alpha).add_(alpha)
+        if self._bn_scale is not None:
+            return torch.addcmul(self._bn_shift.to(x.dtype), x, scale * self._bn_scale.to(x.dtype))
+        out = x * scale
 
         return out
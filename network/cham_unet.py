@@ -95,6 +95,18 @@ class CHAMModel(nn.Module):
 
         self.Conv_1x1 = nn.Conv2d(64, output_ch, kernel_size=1, stride=1, padding=0)
 
+    def fuse_for_inference(self):
+        # inference only, one-way: also folds bn1 / bn4 into tp1 / tp4
+        for i in range(0, len(self.shortcut)):
+            if self.shortcut[i]:
+                tp = getattr(self, f"tp{i + 1}")
+                if i in (0, 3):
+                    tp.fuse(getattr(self, f"bn{i + 1}").eval())
+                    setattr(self, f"bn{i + 1}", nn.Identity())
+                else:
+                    tp.fuse()
+        return self
+
     def forward(self, x):
         if x.size()[1] == 1:
             x = x.repeat(1, 3, 1, 1)
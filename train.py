@@ -54,6 +54,8 @@ if __name__ == '__main__':
     parser.add_argument('--weight_cam', type=float, default=0.1, help='weights of CAM loss')
     parser.add_argument('--weight_cam_subloss', type=float, nargs='+', default=[0.25, 0.5, 0.75, 1],
                         help='sub-weights of CAM loss')
+    parser.add_argument('--compile_blocks', action="store_true", help='torch.compile each transformer block and the CHAM gate')
+    parser.add_argument('--bf16', action="store_true", help='run the forward pass under bfloat16 autocast')
 
     args = parser.parse_args()
     if not args.deterministic:
@@ -117,6 +119,12 @@ if __name__ == '__main__':
     optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.wt_dec, eps=1e-8)
 
     model = model.cuda()
+    if args.compile_blocks:
+        model.compile_blocks()
+        import torch._dynamo
+        # one specialisation per drop_path rate, train/eval mode and batch size in every block
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit,
+                                                     8 * (len(model.conv_trans) + 1))
     model.train()
 
     avg_meter = pyutils.AverageMeter('loss')
@@ -126,7 +134,10 @@ if __name__ == '__main__':
             img, label = sampled_batch['image'], sampled_batch['label']
             img, label = img.cuda(), label.cuda()
 
-            pred1, pred2, cam = model(img)
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=args.bf16):
+                pred1, pred2, cam = model(img)
+            # the losses below stay in fp32
+            pred1, pred2, cam = pred1.float(), pred2.float(), [c.float() for c in cam]
 
             outputs_soft1 = torch.softmax(pred1, dim=1)
             outputs_soft2 = torch.softmax(pred2, dim=1)